@@ -4,9 +4,16 @@ import base64
 from PIL import Image
 import zipfile
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from utils.image_processor import ImageProcessor
 from utils.story_generator import StoryGenerator
 from utils.diffusion_generator import DiffusionGenerator
+from utils.cancellation import CancellationToken, CancelledError
+from utils.hedging import HedgePolicy
+from utils.scheduler import get_scheduler
+from utils.single_flight import get_single_flight
+from utils.consistency_scorer import ConsistencyScorer
 from dotenv import load_dotenv
 load_dotenv()
 # Check if OpenAI API key is loaded
@@ -228,6 +235,8 @@ st.markdown("""
 
 def initialize_generators():
     """Initialize the AI generators"""
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
     if "story_generator" not in st.session_state:
         st.session_state.story_generator = StoryGenerator()
     if "image_processor" not in st.session_state:
@@ -235,6 +244,107 @@ def initialize_generators():
     if "diffusion_generator" not in st.session_state:
         st.session_state.diffusion_generator = DiffusionGenerator()
 
+@st.cache_resource
+def get_hedge_policy():
+    """Process-wide hedge policy so scene latency history is shared by all sessions"""
+    return HedgePolicy(percentile=90, max_hedge_ratio=0.1)
+
+def queue_status(session_id):
+    """Short note on how many calls from other users are ahead of this session"""
+    position = get_scheduler().queue_position(session_id)
+    return f" ({position} requests ahead of you)" if position else ""
+
+def show_service_stats():
+    """Operator view of the load shared by all sessions: scheduling, request coalescing and hedging"""
+    st.markdown("**Scheduler**")
+    st.json(get_scheduler().stats())
+    st.markdown("**Coalesced requests** (per endpoint)")
+    st.json(get_single_flight().stats())
+    hedge_stats = get_hedge_policy().stats()
+    # Latency keys are (model, size, quality) tuples, which JSON cannot use as keys
+    hedge_stats["hedge_delays"] = {
+        " ".join(str(part) for part in key if part) if isinstance(key, tuple) else str(key): delay
+        for key, delay in hedge_stats["hedge_delays"].items()
+    }
+    st.markdown("**Hedged scenes**")
+    st.json(hedge_stats)
+
+def run_with_queue_status(func, progress_bar, session_id, status, poll_interval=0.5):
+    """Run a generation stage on a worker thread, refreshing the progress bar while it waits
+
+    status() returns the (fraction, text) to show. Streamlit calls stay on the
+    script thread, and refreshing the bar regularly lets Streamlit interrupt a
+    superseded run mid-stage.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(func)
+        while True:
+            fraction, text = status()
+            progress_bar.progress(fraction, text=text + queue_status(session_id))
+            try:
+                return future.result(timeout=poll_interval)
+            except FuturesTimeoutError:
+                continue
+    finally:
+        executor.shutdown(wait=False)
+
+# Deadlines (seconds) for a whole story run and for each of its stages
+STORY_DEADLINE = 600
+ANALYSIS_DEADLINE = 90
+STORY_TEXT_DEADLINE = 180
+
+def cancel_active_run(reason="superseded by a newer request"):
+    """Cancel the generation run this session still has in flight, if any"""
+    token = st.session_state.get("active_run_token")
+    if token is not None:
+        token.cancel(reason)
+        st.session_state.active_run_token = None
+
+def start_run():
+    """Start a new generation run, cancelling the one it supersedes"""
+    cancel_active_run()
+    token = CancellationToken(timeout=STORY_DEADLINE)
+    st.session_state.active_run_token = token
+    return token
+
+def create_diffusion_generator(session_id, hedge_slow_scenes):
+    """Build the scene generator for this session's settings"""
+    return DiffusionGenerator(
+        hedge_policy=get_hedge_policy() if hedge_slow_scenes else None,
+        session_id=session_id,
+        consistency_scorer=ConsistencyScorer()
+    )
+
+def display_story(story_result):
+    """Show the story with its scenes and return the indexes of drafts the user accepted"""
+    story_data = story_result["story_data"]
+    accepted = []
+    
+    st.markdown(f'<div class="story-title">{story_data["title"]}</div>', unsafe_allow_html=True)
+    st.markdown(f'<div class="story-text">{story_data["introduction"]}</div>', unsafe_allow_html=True)
+    
+    for i, (scene, scene_image) in enumerate(zip(story_data["scenes"], story_result["scene_images"])):
+        st.markdown(f'<div class="scene-container">', unsafe_allow_html=True)
+        st.markdown(f'<div class="scene-title">Scene {i+1}</div>', unsafe_allow_html=True)
+        st.image(scene_image, use_column_width=True)
+        consistency = story_result["consistency_report"][i]
+        if consistency["failed"]:
+            st.caption("⚠️ This scene could not be drawn")
+        else:
+            st.caption(
+                ("" if story_result["final"][i] else "Draft preview · ")
+                + f"Character match: {consistency['score']:.0%}"
+                + ("" if consistency["passed"] else " ⚠️ may not match your character")
+            )
+        if not story_result["final"][i] and st.checkbox("👍 Keep this scene", key=f"accept_scene_{i}"):
+            accepted.append(i)
+        st.markdown(f'<div class="story-text">{scene["narrative"]}</div>', unsafe_allow_html=True)
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    st.markdown(f'<div class="story-text">{story_data["conclusion"]}</div>', unsafe_allow_html=True)
+    return accepted
+
 def create_story_package(story_data, scene_images):
     """Create a downloadable package of the story and images"""
     try:
@@ -289,6 +399,9 @@ def main():
     # Initialize generators
     initialize_generators()
     
+    # Any rerun (new click, changed setting) supersedes work still in flight
+    cancel_active_run()
+    
     # Sidebar for configuration with cartoon style
     with st.sidebar:
         st.markdown("### 🎭 Story Settings")
@@ -316,8 +429,32 @@ def main():
         
         st.markdown("### ⚡ Generation Settings")
         
-        guidance_scale = st.slider("🎯 Style Strength", min_value=5.0, max_value=20.0, value=7.5, step=0.5)
-        num_inference_steps = st.slider("✨ Detail Level", min_value=20, max_value=50, value=30)
+        quick_previews = st.checkbox(
+            "⚡ Quick Previews",
+            value=True,
+            help="Draw small, fast drafts of every scene first, then render only the scenes you keep in full quality"
+        )
+        guidance_scale = st.slider(
+            "🎯 Style Strength", min_value=5.0, max_value=20.0, value=7.5, step=0.5,
+            help="How much of your character's look goes into each prompt; 12 and above also uses a more vivid style"
+        )
+        num_inference_steps = st.slider(
+            "✨ Detail Level", min_value=20, max_value=50, value=30,
+            help="Below 30 drafts are tiny and fastest; 40 and above renders final scenes in HD (slower, costlier)"
+        )
+        hedge_slow_scenes = st.checkbox(
+            "⏱️ Retry Slow Scenes",
+            value=True,
+            help="Send a backup request when a scene takes unusually long and keep whichever finishes first"
+        )
+        redraw_off_model = st.checkbox(
+            "🔁 Redraw Off-Model Scenes",
+            value=False,
+            help="Redraw scenes whose colors and style drift too far from your character image"
+        )
+        
+        with st.expander("📊 Service Stats"):
+            show_service_stats()
         
         st.markdown('</div>', unsafe_allow_html=True)
     
@@ -341,50 +478,131 @@ def main():
 
     with col2:
         if uploaded_file and image is not None:
+            session_id = st.session_state.session_id
             if st.button("🎨 Create Cartoon Story", use_container_width=True):
+                run_token = start_run()
+                # A new story replaces the previous one, including its drafts
+                st.session_state.story_result = None
+                for key in [key for key in st.session_state if key.startswith("accept_scene_")]:
+                    del st.session_state[key]
                 with st.spinner("Creating your magical story..."):
+                    progress_bar = st.progress(0.0, text="Studying your character...")
                     try:
                         # Process image and generate story
-                        image_processor = ImageProcessor()
-                        image_analysis = image_processor.analyze_image(image)
-                        
-                        story_generator = StoryGenerator()
-                        story_data = story_generator.generate_story(
-                            image_analysis=image_analysis,
-                            num_scenes=num_scenes,
-                            genre=story_genre,
-                            story_idea=story_idea,
-                            words_per_page=words_per_page
+                        image_processor = ImageProcessor(session_id=session_id)
+                        image_analysis = run_with_queue_status(
+                            lambda: image_processor.analyze_image(
+                                image,
+                                cancel_token=run_token.child(timeout=ANALYSIS_DEADLINE)
+                            ),
+                            progress_bar, session_id,
+                            lambda: (0.0, "Studying your character...")
                         )
                         
-                        # Display story
-                        st.markdown(f'<div class="story-title">{story_data["title"]}</div>', unsafe_allow_html=True)
-                        st.markdown(f'<div class="story-text">{story_data["introduction"]}</div>', unsafe_allow_html=True)
-                        
-                        # Generate and display scenes
-                        diffusion_generator = DiffusionGenerator()
-                        scene_images = diffusion_generator.batch_generate_scenes(
-                            image,
-                            [scene["description"] for scene in story_data["scenes"]],
-                            guidance_scale=guidance_scale,
-                            num_inference_steps=num_inference_steps
+                        story_generator = StoryGenerator(session_id=session_id)
+                        story_data = run_with_queue_status(
+                            lambda: story_generator.generate_story(
+                                image_analysis=image_analysis,
+                                num_scenes=num_scenes,
+                                genre=story_genre,
+                                story_idea=story_idea,
+                                words_per_page=words_per_page,
+                                cancel_token=run_token.child(timeout=STORY_TEXT_DEADLINE)
+                            ),
+                            progress_bar, session_id,
+                            lambda: (0.0, "Writing the story...")
                         )
                         
-                        for i, (scene, scene_image) in enumerate(zip(story_data["scenes"], scene_images)):
-                            st.markdown(f'<div class="scene-container">', unsafe_allow_html=True)
-                            st.markdown(f'<div class="scene-title">Scene {i+1}</div>', unsafe_allow_html=True)
-                            st.image(scene_image, use_column_width=True)
-                            st.markdown(f'<div class="story-text">{scene["narrative"]}</div>', unsafe_allow_html=True)
-                            st.markdown('</div>', unsafe_allow_html=True)
-                        
-                        st.markdown(f'<div class="story-text">{story_data["conclusion"]}</div>', unsafe_allow_html=True)
+                        # Generate scenes; the callback runs on worker threads, so it only records progress
+                        diffusion_generator = create_diffusion_generator(session_id, hedge_slow_scenes)
+                        scene_descriptions = [scene["description"] for scene in story_data["scenes"]]
+                        scene_progress = {"done": 0, "total": len(scene_descriptions)}
+                        scene_images, consistency_report = run_with_queue_status(
+                            lambda: diffusion_generator.batch_generate_scenes(
+                                image,
+                                scene_descriptions,
+                                guidance_scale=guidance_scale,
+                                num_inference_steps=num_inference_steps,
+                                cancel_token=run_token,
+                                progress_callback=lambda done, total: scene_progress.update(done=done, total=total),
+                                regenerate_inconsistent=redraw_off_model,
+                                return_scores=True,
+                                quality_tier="draft" if quick_previews else "final"
+                            ),
+                            progress_bar, session_id,
+                            lambda: (
+                                scene_progress["done"] / scene_progress["total"],
+                                f"Drew {scene_progress['done']} of {scene_progress['total']} scenes"
+                            )
+                        )
                         
-                        # Download button
-                        if st.button("📥 Download Story Package", use_container_width=True):
-                            create_story_package(story_data, scene_images)
+                        st.session_state.story_result = {
+                            "story_data": story_data,
+                            "scene_images": scene_images,
+                            "scene_prompts": diffusion_generator.last_scene_prompts,
+                            "consistency_report": consistency_report,
+                            "final": [not quick_previews] * len(scene_images)
+                        }
                             
+                    except CancelledError as e:
+                        st.warning(f"Story creation stopped: {str(e)}")
                     except Exception as e:
                         st.error(f"Oops! Something went wrong: {str(e)}")
+                    finally:
+                        # Also runs when Streamlit interrupts the script (rerun, tab closed)
+                        run_token.cancel("finished")
+                        progress_bar.empty()
+            
+            story_result = st.session_state.get("story_result")
+            if story_result is not None:
+                accepted = display_story(story_result)
+                pending = [i for i in accepted if not story_result["final"][i]]
+                
+                if pending and st.button(f"✨ Render {len(pending)} Final Scene(s)", use_container_width=True):
+                    run_token = start_run()
+                    upgraded = False
+                    with st.spinner("Rendering final scenes..."):
+                        progress_bar = st.progress(0.0, text="Rendering final scenes...")
+                        try:
+                            diffusion_generator = create_diffusion_generator(session_id, hedge_slow_scenes)
+                            upgrade_progress = {"done": 0, "total": len(pending)}
+                            final_images = run_with_queue_status(
+                                lambda: diffusion_generator.upgrade_scenes(
+                                    image,
+                                    [scene["description"] for scene in story_result["story_data"]["scenes"]],
+                                    story_result["scene_prompts"],
+                                    pending,
+                                    guidance_scale=guidance_scale,
+                                    num_inference_steps=num_inference_steps,
+                                    cancel_token=run_token,
+                                    progress_callback=lambda done, total: upgrade_progress.update(done=done, total=total)
+                                ),
+                                progress_bar, session_id,
+                                lambda: (
+                                    upgrade_progress["done"] / upgrade_progress["total"],
+                                    f"Rendered {upgrade_progress['done']} of {upgrade_progress['total']} final scenes"
+                                )
+                            )
+                            for i, final_image in final_images.items():
+                                story_result["scene_images"][i] = final_image
+                                story_result["final"][i] = True
+                            story_result["consistency_report"] = diffusion_generator.score_consistency(
+                                image, story_result["scene_images"]
+                            )
+                            upgraded = True
+                        except CancelledError as e:
+                            st.warning(f"Final rendering stopped: {str(e)}")
+                        except Exception as e:
+                            st.error(f"Oops! Something went wrong: {str(e)}")
+                        finally:
+                            run_token.cancel("finished")
+                            progress_bar.empty()
+                    if upgraded:
+                        st.rerun()
+                
+                # Download button
+                if st.button("📥 Download Story Package", use_container_width=True):
+                    create_story_package(story_result["story_data"], story_result["scene_images"])
         else:
             st.markdown('''
                 <div style="text-align: center; padding: 2rem;">
@@ -0,0 +1,119 @@
+import threading
+import time
+
+# Matches the OpenAI client's own default so calls without a deadline behave as before
+DEFAULT_REQUEST_TIMEOUT = 600.0
+
+
+class CancelledError(Exception):
+    """Raised when work is abandoned because its token was cancelled or its deadline passed"""
+    pass
+
+
+class CancellationToken:
+    def __init__(self, timeout=None, parent=None):
+        """Create a token, optionally with a deadline in seconds and a parent it inherits cancellation from"""
+        self._event = threading.Event()
+        self._reason = None
+        self._children = []
+        self._lock = threading.Lock()
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if parent is not None and parent.deadline is not None:
+            deadline = parent.deadline if deadline is None else min(deadline, parent.deadline)
+        self.deadline = deadline
+
+        if parent is not None:
+            parent._add_child(self)
+
+    def _add_child(self, child):
+        """Register a child token so cancelling this token cancels it too"""
+        with self._lock:
+            if not self._event.is_set():
+                self._children.append(child)
+                return
+        child.cancel(self._reason)
+
+    def child(self, timeout=None):
+        """Create a token for a sub-stage with its own (tighter) deadline"""
+        return CancellationToken(timeout=timeout, parent=self)
+
+    def cancel(self, reason="cancelled"):
+        """Cancel this token and every token derived from it"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._reason = reason
+            self._event.set()
+            children, self._children = self._children, []
+        for child in children:
+            child.cancel(reason)
+
+    def remaining(self):
+        """Seconds left before the deadline, or None when there is no deadline"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def is_cancelled(self):
+        """Check whether the token was cancelled or its deadline has passed"""
+        if self._event.is_set():
+            return True
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline exceeded")
+            return True
+        return False
+
+    @property
+    def reason(self):
+        """Why the token was cancelled, if it was"""
+        return self._reason
+
+    def raise_if_cancelled(self):
+        """Raise CancelledError if the work guarded by this token should stop"""
+        if self.is_cancelled():
+            raise CancelledError(f"Generation {self._reason}")
+
+
+def request_timeout(cancel_token, default=DEFAULT_REQUEST_TIMEOUT):
+    """Per-request timeout to pass to the OpenAI client so in-flight calls stop at the deadline"""
+    if cancel_token is None:
+        return default
+    cancel_token.raise_if_cancelled()
+    remaining = cancel_token.remaining()
+    if remaining is None:
+        return default
+    return min(default, remaining)
+
+
+def run_cancellable(func, cancel_token=None, poll_interval=0.1):
+    """Run a blocking call, abandoning it as soon as the token is cancelled
+
+    The call keeps running on a daemon thread after it is abandoned (a blocking
+    HTTP request cannot be interrupted), but its result is discarded and the
+    caller is released immediately.
+    """
+    if cancel_token is None:
+        return func()
+
+    cancel_token.raise_if_cancelled()
+
+    outcome = {}
+    done = threading.Event()
+
+    def target():
+        try:
+            outcome["result"] = func()
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=target, daemon=True).start()
+
+    while not done.wait(poll_interval):
+        cancel_token.raise_if_cancelled()
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
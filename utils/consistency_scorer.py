@@ -0,0 +1,136 @@
+import itertools
+import numpy as np
+from PIL import Image
+
+
+class ConsistencyScorer:
+    def __init__(self, size=64, bins=8, palette_size=6, weights=None):
+        """Local, vectorized scoring of how closely scenes match the reference image
+
+        Every score is in [0, 1] and combines color-histogram overlap, distance
+        between dominant palettes and cheap structural (edge/texture) statistics.
+        No model calls are made, so a whole batch scores in milliseconds.
+
+        The raw components give partial credit even to unrelated images, so the
+        overall score is rescaled against the reference's score on a fixed set
+        of unrelated baselines (noise and flat colors): an unrelated image lands
+        near 0 and an identical one at 1.
+        """
+        self.size = size
+        self.bins = bins
+        self.palette_size = palette_size
+        self.weights = weights or {"histogram": 0.4, "palette": 0.35, "structure": 0.25}
+
+        # RGB center of every histogram bin, used to turn bins into palette colors
+        levels = (np.arange(bins, dtype=np.float32) + 0.5) / bins
+        r, g, b = np.meshgrid(levels, levels, levels, indexing="ij")
+        self._bin_centers = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+
+        # Unrelated images the reference is scored against to find its noise floor
+        rng = np.random.default_rng(0)
+        self._baselines = [Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))]
+        for color in list(itertools.product((0, 255), repeat=3)) + [(128, 128, 128)]:
+            self._baselines.append(Image.new('RGB', (size, size), color))
+
+    def _to_array(self, images):
+        """Stack images into an (N, size, size, 3) float array in [0, 1]"""
+        arrays = []
+        for image in images:
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image = image.resize((self.size, self.size), Image.Resampling.BILINEAR)
+            arrays.append(np.asarray(image, dtype=np.float32))
+        return np.stack(arrays) / 255.0
+
+    def _color_histograms(self, pixels):
+        """Normalized joint RGB histograms, shape (N, bins**3)"""
+        n = pixels.shape[0]
+        nbins = self.bins ** 3
+        quantized = np.clip((pixels * self.bins).astype(np.int64), 0, self.bins - 1)
+        index = (quantized[..., 0] * self.bins + quantized[..., 1]) * self.bins + quantized[..., 2]
+        index = index.reshape(n, -1) + (np.arange(n) * nbins)[:, None]
+        counts = np.bincount(index.ravel(), minlength=n * nbins).reshape(n, nbins).astype(np.float32)
+        return counts / counts.sum(axis=1, keepdims=True)
+
+    def _channel_histograms(self, pixels, bins=16):
+        """Smoothed per-channel histograms, shape (N, 3, bins), tolerant of small color shifts"""
+        n = pixels.shape[0]
+        quantized = np.clip((pixels * bins).astype(np.int64), 0, bins - 1).reshape(n, -1, 3)
+        offsets = (np.arange(n)[:, None] * 3 + np.arange(3)[None, :]) * bins
+        index = quantized + offsets[:, None, :]
+        counts = np.bincount(index.ravel(), minlength=n * 3 * bins).reshape(n, 3, bins).astype(np.float32)
+        # Spread each bin into its neighbours so a color near a bin edge still overlaps
+        padded = np.pad(counts, ((0, 0), (0, 0), (1, 1)), mode="edge")
+        smoothed = 0.25 * padded[..., :-2] + 0.5 * padded[..., 1:-1] + 0.25 * padded[..., 2:]
+        return smoothed / smoothed.sum(axis=2, keepdims=True)
+
+    def _palettes(self, histograms):
+        """Dominant colors and their weights, shapes (N, k, 3) and (N, k)"""
+        k = min(self.palette_size, histograms.shape[1])
+        top = np.argpartition(-histograms, k - 1, axis=1)[:, :k]
+        weights = np.take_along_axis(histograms, top, axis=1)
+        weights = weights / np.maximum(weights.sum(axis=1, keepdims=True), 1e-8)
+        return self._bin_centers[top], weights
+
+    def _structure_features(self, pixels):
+        """Edge density, gradient-orientation histogram and tone statistics per image"""
+        luminance = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        gx = np.diff(luminance, axis=2)[:, :-1, :]
+        gy = np.diff(luminance, axis=1)[:, :, :-1]
+        magnitude = np.hypot(gx, gy)
+        n = pixels.shape[0]
+
+        edge_density = (magnitude > 0.1).reshape(n, -1).mean(axis=1)
+
+        orientation = ((np.arctan2(gy, gx) + np.pi) / (2 * np.pi) * 8).astype(np.int64) % 8
+        index = orientation.reshape(n, -1) + (np.arange(n) * 8)[:, None]
+        orientations = np.bincount(
+            index.ravel(), weights=magnitude.ravel(), minlength=n * 8
+        ).reshape(n, 8)
+        totals = orientations.sum(axis=1, keepdims=True)
+        # A flat image has no dominant orientation; treat it as uniform rather than all zeros
+        orientations = np.where(totals > 1e-8, orientations / np.maximum(totals, 1e-8), 1.0 / 8)
+
+        flat = luminance.reshape(n, -1)
+        return edge_density, orientations, flat.mean(axis=1), flat.std(axis=1)
+
+    def score_components(self, reference_image, images):
+        """Per-component similarity of each image to the reference, as arrays of shape (N,)"""
+        pixels = self._to_array([reference_image] + list(images))
+        channels = self._channel_histograms(pixels)
+        histogram_score = np.minimum(channels[:1], channels[1:]).sum(axis=2).mean(axis=1)
+
+        histograms = self._color_histograms(pixels)
+        colors, weights = self._palettes(histograms)
+        # Distance from each reference palette color to the closest scene palette color
+        distances = np.linalg.norm(colors[:1, :, None, :] - colors[1:, None, :, :], axis=-1)
+        nearest = distances.min(axis=2)
+        palette_score = 1.0 - (nearest * weights[:1]).sum(axis=1) / np.sqrt(3.0)
+
+        edges, orientations, brightness, contrast = self._structure_features(pixels)
+        structure_score = (
+            np.minimum(orientations[:1], orientations[1:]).sum(axis=1)
+            + (1.0 - np.minimum(1.0, np.abs(edges[1:] - edges[0]) / max(edges[0], 0.05)))
+            + (1.0 - np.abs(brightness[1:] - brightness[0]))
+            + (1.0 - np.minimum(1.0, np.abs(contrast[1:] - contrast[0]) * 2.0))
+        ) / 4.0
+
+        return {
+            "histogram": histogram_score,
+            "palette": palette_score,
+            "structure": structure_score,
+        }
+
+    def raw_score(self, reference_image, images):
+        """Weighted sum of the components, before rescaling against the noise floor, shape (N,)"""
+        components = self.score_components(reference_image, images)
+        total = sum(self.weights.values())
+        return sum(self.weights[name] * components[name] for name in self.weights) / total
+
+    def score(self, reference_image, images):
+        """Overall consistency score of each image against the reference, shape (N,)"""
+        if not images:
+            return np.zeros(0, dtype=np.float32)
+        raw = self.raw_score(reference_image, list(images) + self._baselines)
+        scores, floor = raw[:len(images)], raw[len(images):].mean()
+        return np.clip((scores - floor) / max(1.0 - floor, 1e-6), 0.0, 1.0)
@@ -2,14 +2,35 @@ import os
 from PIL import Image, ImageDraw, ImageFont
 import io
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from openai import OpenAI
+from utils.cancellation import CancelledError, request_timeout, run_cancellable
+from utils.scheduled_api import ScheduledAPIMixin
+from utils.scheduler import BATCH, INTERACTIVE
+from utils.single_flight import image_key, request_key
 
-class DiffusionGenerator:
-    def __init__(self):
+# "draft" renders cheap, fast previews; "final" renders full-resolution scenes from the same prompts
+QUALITY_TIERS = ("draft", "final")
+
+# DALL-E 2 rejects prompts longer than this
+DRAFT_PROMPT_LIMIT = 1000
+
+class DiffusionGenerator(ScheduledAPIMixin):
+    def __init__(self, hedge_policy=None, max_workers=4, session_id=None, priority=INTERACTIVE,
+                 scheduler=None, single_flight=None, consistency_scorer=None):
         """Initialize the diffusion generator with OpenAI DALL-E"""
         self.openai_client = OpenAI(
             api_key=os.getenv("OPENAI_API_KEY", "your-openai-api-key")
         )
+        self._init_scheduling(session_id, priority, scheduler, single_flight)
+        # Optional utils.hedging.HedgePolicy used to cut the latency tail of slow scenes
+        self.hedge_policy = hedge_policy
+        self.max_workers = max_workers
+        # Optional utils.consistency_scorer.ConsistencyScorer used to flag and redraw off-model scenes
+        self.consistency_scorer = consistency_scorer
+        self.last_consistency_report = None
+        self.last_scene_prompts = None
     
     def _load_models(self):
         """Load the diffusion models - Not needed for OpenAI DALL-E"""
@@ -38,55 +59,138 @@ class DiffusionGenerator:
         except Exception as e:
             raise Exception(f"Failed to prepare reference image: {str(e)}")
     
+    def render_settings(self, quality_tier="final", guidance_scale=7.5, num_inference_steps=30):
+        """Map the quality tier and the Detail Level slider to DALL-E request parameters"""
+        if quality_tier not in QUALITY_TIERS:
+            raise Exception(f"Unknown quality tier: {quality_tier}")
+        
+        if quality_tier == "draft":
+            # DALL-E 2 previews; low detail levels drop to the smallest, fastest size
+            return {
+                "model": "dall-e-2",
+                "size": "256x256" if num_inference_steps < 30 else "512x512"
+            }
+        
+        return {
+            "model": "dall-e-3",
+            "size": "1024x1024",
+            "quality": "hd" if num_inference_steps >= 40 else "standard",
+            "style": "vivid" if guidance_scale >= 12 else "natural"
+        }
+    
+    def build_scene_prompt(self, scene_description, visual_features, guidance_scale=7.5):
+        """Build the consistency prompt for a scene
+        
+        Style Strength (guidance_scale) controls how much of the reference's visual
+        features the prompt carries, so the same prompt can be reused for draft and
+        final renders.
+        """
+        features_length = int(100 + 20 * guidance_scale)
+        
+        # Enhanced prompt to ensure character consistency by referencing the uploaded image
+        # This ensures DALL-E knows to include the same character/subject
+        return (
+            f"Based on the uploaded reference image style and main character: {scene_description}. "
+            f"Important: Feature the exact same main character/subject from the reference image "
+            f"(same species, appearance, colors, and visual style). "
+            f"Maintain identical art style, lighting, and composition approach as the reference. "
+            f"Visual consistency elements: {visual_features[:features_length]}. "
+            f"High quality, detailed, consistent character design."
+        )
+    
+    def _extract_visual_features(self, reference_image, cancel_token=None):
+        """Extract visual features from reference image to enhance consistency"""
+        from utils.image_processor import ImageProcessor
+        image_processor = ImageProcessor(
+            session_id=self.session_id, priority=self.priority, scheduler=self.scheduler,
+            single_flight=self.single_flight
+        )
+        return image_processor.extract_visual_features(reference_image, cancel_token=cancel_token)
+    
     def generate_scene_image(self, reference_image, scene_description, 
-                           guidance_scale=7.5, num_inference_steps=30, strength=0.75):
-        """Generate an image for a specific scene maintaining consistency with reference"""
+                           guidance_scale=7.5, num_inference_steps=30, strength=0.75, cancel_token=None,
+                           quality_tier="final", prompt=None, priority=None):
+        """Generate an image for a specific scene maintaining consistency with reference
+        
+        Pass the prompt of an earlier render to re-render the same scene, e.g. to
+        upgrade a draft to the final tier. priority overrides the generator's
+        scheduling class for this scene's calls.
+        """
         try:
-            # Extract visual features from reference image to enhance consistency
-            from utils.image_processor import ImageProcessor
-            image_processor = ImageProcessor()
-            visual_features = image_processor.extract_visual_features(reference_image)
-            
-            # Enhanced prompt to ensure character consistency by referencing the uploaded image
-            # This ensures DALL-E knows to include the same character/subject
-            consistency_prompt = (
-                f"Based on the uploaded reference image style and main character: {scene_description}. "
-                f"Important: Feature the exact same main character/subject from the reference image "
-                f"(same species, appearance, colors, and visual style). "
-                f"Maintain identical art style, lighting, and composition approach as the reference. "
-                f"Visual consistency elements: {visual_features[:200]}. "
-                f"High quality, detailed, consistent character design."
-            )
-            
-            full_prompt = consistency_prompt
-            
-            # Generate image using OpenAI DALL-E 3
-            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-            # do not change this unless explicitly requested by the user
-            response = self.openai_client.images.generate(
-                model="dall-e-3",
-                prompt=full_prompt,
-                n=1,
-                size="1024x1024",
-                quality="standard"
-            )
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
             
-            # Download the generated image
-            import requests
-            image_url = response.data[0].url
-            image_response = requests.get(image_url)
+            settings = self.render_settings(quality_tier, guidance_scale, num_inference_steps)
             
-            if image_response.status_code == 200:
-                generated_image = Image.open(io.BytesIO(image_response.content))
-                return generated_image
+            # strength does not reach DALL-E, so it is not part of the key
+            if prompt is None:
+                key = request_key(image_key(reference_image), scene_description, guidance_scale, settings)
             else:
-                raise Exception(f"Failed to download generated image: HTTP {image_response.status_code}")
+                key = request_key(prompt, settings)
+            return self.single_flight.do(
+                "generate_scene_image",
+                key,
+                lambda: self._generate_scene_image(
+                    reference_image, scene_description, guidance_scale, settings, cancel_token, prompt,
+                    priority
+                ),
+                cancel_token
+            )
             
+        except CancelledError:
+            raise
         except Exception as e:
             # Return a placeholder image if generation fails
             placeholder = self._create_error_placeholder(str(e))
             return placeholder
     
+    def _generate_scene_image(self, reference_image, scene_description, guidance_scale, settings,
+                              cancel_token=None, prompt=None, priority=None):
+        """Build the consistency prompt for a scene (unless given) and render it"""
+        if prompt is None:
+            visual_features = self._extract_visual_features(reference_image, cancel_token)
+            prompt = self.build_scene_prompt(scene_description, visual_features, guidance_scale)
+        
+        # Hedge the render only; the visual features above are shared by both attempts.
+        # The duplicate is speculative, so it queues behind interactive work.
+        if self.hedge_policy is not None:
+            return self.hedge_policy.run(
+                lambda attempt_token, hedged, on_start: self._render_image(
+                    prompt, settings, attempt_token, BATCH if hedged else priority, on_start
+                ),
+                cancel_token,
+                # Draft and final renders take very different times, so each keeps its own history
+                latency_key=(settings["model"], settings["size"], settings.get("quality"))
+            )
+        return self._render_image(prompt, settings, cancel_token, priority)
+    
+    def _render_image(self, prompt, settings, cancel_token=None, priority=None, on_admit=None):
+        """Render a prompt with DALL-E and download the result"""
+        if settings["model"] == "dall-e-2":
+            prompt = prompt[:DRAFT_PROMPT_LIMIT]
+        
+        # Generate image using OpenAI DALL-E
+        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+        # do not change this unless explicitly requested by the user
+        response = self._call_api(lambda: self.openai_client.images.generate(
+            prompt=prompt,
+            n=1,
+            timeout=request_timeout(cancel_token),
+            **settings
+        ), cancel_token, priority=priority, on_admit=on_admit)
+        
+        # Download the generated image
+        import requests
+        image_url = response.data[0].url
+        image_response = run_cancellable(
+            lambda: requests.get(image_url, timeout=request_timeout(cancel_token, default=60.0)),
+            cancel_token
+        )
+        
+        if image_response.status_code == 200:
+            return Image.open(io.BytesIO(image_response.content))
+        raise Exception(f"Failed to download generated image: HTTP {image_response.status_code}")
+    
     def _create_error_placeholder(self, error_message):
         """Create a placeholder image when generation fails"""
         try:
@@ -101,11 +205,17 @@ class DiffusionGenerator:
                          fill=(100, 100, 100))
             except:
                 pass
-            
-            return placeholder
         except:
             # If even placeholder creation fails, create minimal image
-            return Image.new('RGB', (512, 512), (200, 200, 200))
+            placeholder = Image.new('RGB', (512, 512), (200, 200, 200))
+        
+        # Tagged so consistency checks treat the scene as failed instead of scoring the grey canvas
+        placeholder.info["generation_error"] = error_message
+        return placeholder
+    
+    def is_error_placeholder(self, image):
+        """Check whether an image is the placeholder of a failed render"""
+        return "generation_error" in image.info
     
     def adjust_consistency_strength(self, scene_index, total_scenes):
         """Adjust strength parameter based on scene position for narrative flow"""
@@ -120,28 +230,174 @@ class DiffusionGenerator:
         else:
             return 0.8  # Allow more deviation for story progression
     
+    def consistency_threshold(self, scene_index, total_scenes):
+        """Minimum consistency score for a scene, looser where more deviation from the reference is allowed
+        
+        Scores are rescaled so unrelated images land near 0, and these thresholds
+        (0.40 to 0.50) sit well clear of that floor.
+        """
+        strength = self.adjust_consistency_strength(scene_index, total_scenes)
+        return round(0.8 - 0.5 * strength, 2)
+    
+    def _score_images(self, reference_image, images):
+        """Consistency score of each image, 0 for the placeholders of failed renders"""
+        scores = np.zeros(len(images))
+        rendered = [i for i, image in enumerate(images) if not self.is_error_placeholder(image)]
+        if rendered:
+            scores[rendered] = self.consistency_scorer.score(reference_image, [images[i] for i in rendered])
+        return scores
+    
+    def score_consistency(self, reference_image, images):
+        """Score every image against the reference and compare with its positional threshold
+        
+        Failed renders are not scored; they are reported as failed and never pass.
+        """
+        scores = self._score_images(reference_image, images)
+        report = []
+        for i, score in enumerate(scores):
+            threshold = self.consistency_threshold(i, len(images))
+            failed = self.is_error_placeholder(images[i])
+            report.append({
+                "score": float(score),
+                "threshold": threshold,
+                "passed": bool(not failed and score >= threshold),
+                "failed": failed,
+                "regenerated": False
+            })
+        return report
+    
     def batch_generate_scenes(self, reference_image, scene_descriptions,
-                            guidance_scale=7.5, num_inference_steps=30):
-        """Generate all scene images in batch for better consistency"""
-        generated_images = []
+                            guidance_scale=7.5, num_inference_steps=30, cancel_token=None,
+                            progress_callback=None, regenerate_inconsistent=False, return_scores=False,
+                            quality_tier="final", scene_prompts=None):
+        """Generate all scene images in batch for better consistency
+        
+        With a consistency scorer configured, every scene is scored locally against
+        the reference. Scenes below their threshold are flagged and, with
+        regenerate_inconsistent, redrawn once, keeping the better-scoring image.
+        With return_scores the result is (images, report) instead of just images.
+        
+        The prompts used are kept in last_scene_prompts so accepted drafts can be
+        upgraded to the final tier with upgrade_scenes.
+        """
+        total_scenes = len(scene_descriptions)
+        if scene_prompts is None:
+            scene_prompts = self._build_scene_prompts(reference_image, scene_descriptions, guidance_scale, cancel_token)
+        self.last_scene_prompts = list(scene_prompts)
+        
+        scenes = {i: (scene_descriptions[i], scene_prompts[i]) for i in range(total_scenes)}
+        generated = self._generate_scenes(
+            reference_image, scenes, total_scenes, guidance_scale, num_inference_steps,
+            quality_tier, cancel_token, progress_callback
+        )
+        generated_images = [generated[i] for i in range(total_scenes)]
         
-        for i, description in enumerate(scene_descriptions):
-            # Adjust strength based on scene position
-            strength = self.adjust_consistency_strength(i, len(scene_descriptions))
+        report = None
+        if self.consistency_scorer is not None and generated_images:
+            report = self.score_consistency(reference_image, generated_images)
             
-            try:
-                image = self.generate_scene_image(
+            retry = {}
+            if regenerate_inconsistent:
+                hint = ". Match the reference character's colors, palette and art style exactly"
+                retry = {
+                    i: (description + hint, scene_prompts[i] + hint if scene_prompts[i] else None)
+                    for i, description in enumerate(scene_descriptions)
+                    if not report[i]["passed"]
+                }
+            if retry:
+                # Redraws extend the progress past the first pass instead of going quiet
+                redraw_progress = None
+                if progress_callback is not None:
+                    redraw_progress = lambda done, total: progress_callback(total_scenes + done, total_scenes + total)
+                # Redraws are a best-effort improvement, so they yield to other sessions' first renders
+                regenerated = self._generate_scenes(
+                    reference_image, retry, total_scenes, guidance_scale, num_inference_steps,
+                    quality_tier, cancel_token, redraw_progress, priority=BATCH
+                )
+                indexes = sorted(regenerated)
+                new_scores = self._score_images(reference_image, [regenerated[i] for i in indexes])
+                for i, score in zip(indexes, new_scores):
+                    report[i]["regenerated"] = True
+                    failed = self.is_error_placeholder(regenerated[i])
+                    # Any real image beats a failed render, otherwise keep the better-scoring one
+                    if not failed and (report[i]["failed"] or score > report[i]["score"]):
+                        generated_images[i] = regenerated[i]
+                        self.last_scene_prompts[i] = retry[i][1]
+                        report[i]["score"] = float(score)
+                        report[i]["passed"] = bool(score >= report[i]["threshold"])
+                        report[i]["failed"] = False
+        
+        self.last_consistency_report = report
+        return (generated_images, report) if return_scores else generated_images
+    
+    def upgrade_scenes(self, reference_image, scene_descriptions, scene_prompts, scene_indexes,
+                       guidance_scale=7.5, num_inference_steps=30, cancel_token=None, progress_callback=None):
+        """Re-render the chosen scenes at the final tier from the prompts of their drafts
+        
+        Returns {scene index: image} for the requested indexes.
+        """
+        scenes = {i: (scene_descriptions[i], scene_prompts[i]) for i in scene_indexes}
+        return self._generate_scenes(
+            reference_image, scenes, len(scene_descriptions), guidance_scale, num_inference_steps,
+            "final", cancel_token, progress_callback
+        )
+    
+    def _build_scene_prompts(self, reference_image, scene_descriptions, guidance_scale, cancel_token=None):
+        """Build every scene's prompt from a single visual-features extraction"""
+        try:
+            visual_features = self._extract_visual_features(reference_image, cancel_token)
+        except CancelledError:
+            raise
+        except Exception:
+            # Leave the prompts to each scene, which will report the failure in its placeholder
+            return [None] * len(scene_descriptions)
+        return [self.build_scene_prompt(description, visual_features, guidance_scale)
+                for description in scene_descriptions]
+    
+    def _generate_scenes(self, reference_image, scenes, total_scenes, guidance_scale, num_inference_steps,
+                         quality_tier="final", cancel_token=None, progress_callback=None, priority=None):
+        """Render {scene index: (description, prompt)} concurrently and return {scene index: image}"""
+        # Scenes are rendered concurrently; a story is only done when its slowest scene is
+        generated_images = {}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        
+        try:
+            futures = {}
+            for i, (description, prompt) in scenes.items():
+                # Adjust strength based on scene position
+                strength = self.adjust_consistency_strength(i, total_scenes)
+                
+                future = executor.submit(
+                    self.generate_scene_image,
                     reference_image=reference_image,
                     scene_description=description,
                     guidance_scale=guidance_scale,
                     num_inference_steps=num_inference_steps,
-                    strength=strength
+                    strength=strength,
+                    cancel_token=cancel_token,
+                    quality_tier=quality_tier,
+                    prompt=prompt,
+                    priority=priority
                 )
-                generated_images.append(image)
+                futures[future] = i
+            
+            completed = 0
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    generated_images[i] = future.result()
+                    
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    # Add placeholder if individual generation fails
+                    generated_images[i] = self._create_error_placeholder(f"Scene {i+1} generation failed: {str(e)}")
                 
-            except Exception as e:
-                # Add placeholder if individual generation fails
-                placeholder = self._create_error_placeholder(f"Scene {i+1} generation failed: {str(e)}")
-                generated_images.append(placeholder)
+                completed += 1
+                if progress_callback is not None:
+                    progress_callback(completed, len(scenes))
+        finally:
+            # Scenes that have not started yet are skipped when the batch is abandoned
+            executor.shutdown(wait=False, cancel_futures=True)
         
         return generated_images
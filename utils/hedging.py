@@ -0,0 +1,169 @@
+import queue
+import threading
+import time
+from collections import deque
+from utils.cancellation import CancellationToken
+
+
+class LatencyTracker:
+    def __init__(self, window=200):
+        """Keep a sliding window of recent call latencies"""
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """Record the latency of one completed call"""
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, pct):
+        """Latency at the given percentile (0-100) of the window, or None when empty"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+
+class HedgePolicy:
+    def __init__(self, percentile=90, max_hedge_ratio=0.1, min_samples=5, min_delay=2.0, window=200):
+        """Configure when a duplicate (hedge) request is launched
+
+        A hedge is sent once a call has been running longer than the tracked
+        latency percentile, but only while hedges stay under max_hedge_ratio of
+        all calls so the extra cost is bounded. Latency history is kept per
+        latency key, so calls with very different costs (e.g. draft and final
+        renders) do not share one percentile.
+        """
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.window = window
+        self._trackers = {}
+        self._lock = threading.Lock()
+        self.total_calls = 0
+        self.hedged_calls = 0
+        self.hedge_wins = 0
+
+    def latencies(self, latency_key=None):
+        """The latency tracker for one kind of call, created on first use"""
+        with self._lock:
+            tracker = self._trackers.get(latency_key)
+            if tracker is None:
+                tracker = self._trackers[latency_key] = LatencyTracker(window=self.window)
+            return tracker
+
+    def hedge_delay(self, latency_key=None):
+        """Seconds to wait before hedging, or None while there is too little latency history"""
+        latencies = self.latencies(latency_key)
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, latencies.percentile(self.percentile))
+
+    def _acquire_hedge(self):
+        """Reserve a hedge if doing so keeps the hedge ratio under the cap"""
+        with self._lock:
+            if self.hedged_calls + 1 > self.max_hedge_ratio * self.total_calls:
+                return False
+            self.hedged_calls += 1
+            return True
+
+    def stats(self):
+        """Counters for monitoring the cost and benefit of hedging"""
+        with self._lock:
+            latency_keys = list(self._trackers)
+        hedge_delays = {key: self.hedge_delay(key) for key in latency_keys}
+        with self._lock:
+            return {
+                "total_calls": self.total_calls,
+                "hedged_calls": self.hedged_calls,
+                "hedge_wins": self.hedge_wins,
+                "hedge_ratio": self.hedged_calls / self.total_calls if self.total_calls else 0.0,
+                "hedge_delays": hedge_delays,
+            }
+
+    def run(self, func, cancel_token=None, poll_interval=0.1, latency_key=None):
+        """Call func(cancel_token, hedged, on_start), hedging it with a duplicate call if it runs too long
+
+        hedged is False for the primary attempt and True for the duplicate, so
+        callers can submit the speculative request at a lower priority. func
+        calls on_start() when its request actually begins service (e.g. once
+        the scheduler admits it): the hedge timer and the recorded latency both
+        start there, so a primary that is only queued is never duplicated.
+        latency_key selects the latency history the call is timed against.
+
+        Whichever attempt succeeds first wins and the other attempt's token is
+        cancelled. If every attempt fails, the first error is raised.
+        """
+        with self._lock:
+            self.total_calls += 1
+
+        results = queue.Queue()
+        attempts = []
+        # attempt index -> time the attempt was admitted and started service
+        started = {}
+
+        def launch(attempt_index):
+            token = CancellationToken(parent=cancel_token)
+            attempts.append(token)
+
+            def on_start():
+                started.setdefault(attempt_index, time.monotonic())
+
+            def target():
+                try:
+                    value = func(token, attempt_index > 0, on_start)
+                    results.put((attempt_index, True, value))
+                except BaseException as e:
+                    results.put((attempt_index, False, e))
+
+            threading.Thread(target=target, daemon=True).start()
+
+        launched_at = time.monotonic()
+        launch(0)
+        latencies = self.latencies(latency_key)
+        delay = self.hedge_delay(latency_key)
+        hedge_pending = delay is not None
+        pending = 1
+        first_error = None
+
+        try:
+            while True:
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+
+                primary_started = started.get(0)
+                if hedge_pending and primary_started is not None and time.monotonic() >= primary_started + delay:
+                    hedge_pending = False
+                    if self._acquire_hedge():
+                        launch(1)
+                        pending += 1
+
+                try:
+                    attempt_index, ok, value = results.get(timeout=poll_interval)
+                except queue.Empty:
+                    continue
+
+                pending -= 1
+                if ok:
+                    # Service time of the primary: when a hedge wins, the primary it replaced
+                    # is censored at this time rather than dropped, so slow calls still count
+                    latencies.record(time.monotonic() - started.get(0, launched_at))
+                    if attempt_index > 0:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return value
+
+                if first_error is None:
+                    first_error = value
+                if pending == 0:
+                    raise first_error
+        finally:
+            for token in attempts:
+                token.cancel("superseded by hedged request")
@@ -3,13 +3,18 @@ import io
 from PIL import Image
 import os
 from openai import OpenAI
+from utils.cancellation import CancelledError, request_timeout
+from utils.scheduled_api import ScheduledAPIMixin
+from utils.scheduler import INTERACTIVE
+from utils.single_flight import image_key
 
-class ImageProcessor:
-    def __init__(self):
+class ImageProcessor(ScheduledAPIMixin):
+    def __init__(self, session_id=None, priority=INTERACTIVE, scheduler=None, single_flight=None):
         """Initialize the image processor with OpenAI client"""
         self.openai_client = OpenAI(
             api_key=os.getenv("OPENAI_API_KEY", "your-openai-api-key")
         )
+        self._init_scheduling(session_id, priority, scheduler, single_flight)
     
     def image_to_base64(self, image):
         """Convert PIL Image to base64 string"""
@@ -37,9 +42,12 @@ class ImageProcessor:
         except Exception as e:
             raise Exception(f"Failed to resize image: {str(e)}")
     
-    def analyze_image(self, image):
+    def analyze_image(self, image, cancel_token=None):
         """Analyze uploaded image using OpenAI's vision capabilities"""
         try:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            
             # Resize image to reasonable size for API
             processed_image = self.resize_image(image.copy())
             
@@ -49,7 +57,7 @@ class ImageProcessor:
             # Analyze with OpenAI vision
             # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
             # do not change this unless explicitly requested by the user
-            response = self.openai_client.chat.completions.create(
+            response = self._call_api(lambda: self.openai_client.chat.completions.create(
                 model="gpt-4o",
                 messages=[
                     {
@@ -76,17 +84,23 @@ class ImageProcessor:
                         ]
                     }
                 ],
-                max_tokens=800
-            )
+                max_tokens=800,
+                timeout=request_timeout(cancel_token)
+            ), cancel_token, coalesce_key=("analyze_image", image_key(processed_image)))
             
             return response.choices[0].message.content
             
+        except CancelledError:
+            raise
         except Exception as e:
             raise Exception(f"Failed to analyze image: {str(e)}")
     
-    def extract_visual_features(self, image):
+    def extract_visual_features(self, image, cancel_token=None):
         """Extract key visual features for consistency prompts"""
         try:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            
             # Resize image for processing
             processed_image = self.resize_image(image.copy())
             image_base64 = self.image_to_base64(processed_image)
@@ -94,7 +108,7 @@ class ImageProcessor:
             # Extract specific visual features for consistency
             # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
             # do not change this unless explicitly requested by the user
-            response = self.openai_client.chat.completions.create(
+            response = self._call_api(lambda: self.openai_client.chat.completions.create(
                 model="gpt-4o",
                 messages=[
                     {
@@ -119,10 +133,13 @@ class ImageProcessor:
                         ]
                     }
                 ],
-                max_tokens=500
-            )
+                max_tokens=500,
+                timeout=request_timeout(cancel_token)
+            ), cancel_token, coalesce_key=("extract_visual_features", image_key(processed_image)))
             
             return response.choices[0].message.content
             
+        except CancelledError:
+            raise
         except Exception as e:
             raise Exception(f"Failed to extract visual features: {str(e)}")
@@ -0,0 +1,37 @@
+from utils.scheduler import INTERACTIVE, get_scheduler
+from utils.single_flight import get_single_flight
+
+
+class ScheduledAPIMixin:
+    """Shared plumbing for generators whose OpenAI calls go through the scheduler and single-flight group"""
+
+    def _init_scheduling(self, session_id=None, priority=INTERACTIVE, scheduler=None, single_flight=None):
+        """Set up scheduling state; call from the generator's __init__"""
+        # Every model call is admitted by the process-wide scheduler on behalf of this session
+        self.session_id = session_id or "default"
+        self.priority = priority
+        self.scheduler = scheduler or get_scheduler()
+        # Identical requests already in flight (from any session) are shared instead of repeated
+        self.single_flight = single_flight or get_single_flight()
+
+    def _call_api(self, request, cancel_token=None, coalesce_key=None, priority=None, on_admit=None):
+        """Run an OpenAI request through the shared fair scheduler
+
+        coalesce_key is an (endpoint, key) pair; concurrent calls with the same
+        pair share a single upstream request. priority overrides the generator's
+        own class, e.g. BATCH for speculative or background work. on_admit is
+        called when the scheduler grants the request a slot.
+        """
+        def scheduled():
+            return self.scheduler.run(
+                self.session_id,
+                request,
+                priority=self.priority if priority is None else priority,
+                cancel_token=cancel_token,
+                on_admit=on_admit
+            )
+
+        if coalesce_key is None:
+            return scheduled()
+        endpoint, key = coalesce_key
+        return self.single_flight.do(endpoint, key, scheduled, cancel_token)
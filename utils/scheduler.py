@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Priority classes; lower values are served first
+INTERACTIVE = 0
+BATCH = 1
+
+
+class _Ticket:
+    def __init__(self, session_id, priority):
+        """A queued request waiting for a concurrency slot"""
+        self.session_id = session_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+class FairScheduler:
+    def __init__(self, max_concurrency=8):
+        """Admit model calls fairly across sessions under a global concurrency cap
+
+        Waiting calls are grouped by priority. Within a priority class, sessions
+        are served round robin, each taking up to its weight in calls per turn,
+        so one busy session cannot starve the others.
+        """
+        self.max_concurrency = max_concurrency
+        self._cond = threading.Condition()
+        self._active = 0
+        # priority -> OrderedDict(session_id -> deque of tickets); order is the round-robin order
+        self._queues = {INTERACTIVE: OrderedDict(), BATCH: OrderedDict()}
+        self._weights = {}
+        self._served_this_turn = {}
+        self._completed = 0
+        self._wait_times = deque(maxlen=500)
+
+    def set_weight(self, session_id, weight):
+        """Let a session take more (or fewer) calls per round-robin turn"""
+        with self._cond:
+            self._weights[session_id] = max(1, int(weight))
+
+    def run(self, session_id, func, priority=INTERACTIVE, cancel_token=None, poll_interval=0.1, on_admit=None):
+        """Wait for a slot on behalf of session_id, then call func() while holding it
+
+        on_admit, if given, is called once the slot is granted, so callers can
+        tell queueing time from service time. With a cancel_token the call runs on a worker thread and the caller is
+        released as soon as the token is cancelled. The slot stays taken until
+        the call itself returns, because an abandoned HTTP request still uses
+        upstream capacity until it completes.
+        """
+        self._acquire(session_id, priority, cancel_token, poll_interval)
+        if on_admit is not None:
+            on_admit()
+        if cancel_token is None:
+            try:
+                return func()
+            finally:
+                self._release()
+
+        if cancel_token.is_cancelled():
+            self._release()
+            cancel_token.raise_if_cancelled()
+
+        outcome = {}
+        done = threading.Event()
+
+        def target():
+            try:
+                outcome["result"] = func()
+            except BaseException as e:
+                outcome["error"] = e
+            finally:
+                self._release()
+                done.set()
+
+        threading.Thread(target=target, daemon=True).start()
+
+        while not done.wait(poll_interval):
+            cancel_token.raise_if_cancelled()
+
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
+
+    def _acquire(self, session_id, priority, cancel_token, poll_interval):
+        """Queue a ticket and block until the dispatcher grants it"""
+        ticket = _Ticket(session_id, priority)
+        with self._cond:
+            self._queues[priority].setdefault(session_id, deque()).append(ticket)
+            self._dispatch()
+            try:
+                while not ticket.granted:
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    self._cond.wait(poll_interval)
+            except BaseException:
+                if ticket.granted:
+                    self._active -= 1
+                    self._dispatch()
+                else:
+                    self._remove(ticket)
+                raise
+            self._wait_times.append(time.monotonic() - ticket.enqueued_at)
+
+    def _release(self):
+        """Free a slot and hand it to the next waiting call"""
+        with self._cond:
+            self._active -= 1
+            self._completed += 1
+            self._dispatch()
+
+    def _remove(self, ticket):
+        """Drop a ticket whose caller gave up waiting"""
+        sessions = self._queues[ticket.priority]
+        tickets = sessions.get(ticket.session_id)
+        if tickets is None:
+            return
+        try:
+            tickets.remove(ticket)
+        except ValueError:
+            return
+        if not tickets:
+            del sessions[ticket.session_id]
+            self._served_this_turn.pop((ticket.priority, ticket.session_id), None)
+
+    def _next_ticket(self, queues, served):
+        """Pop the next ticket in fair order from the given queues (mutated in place)"""
+        for priority in sorted(queues):
+            sessions = queues[priority]
+            if not sessions:
+                continue
+            session_id, tickets = next(iter(sessions.items()))
+            ticket = tickets.popleft()
+            key = (priority, session_id)
+            served[key] = served.get(key, 0) + 1
+            if not tickets:
+                del sessions[session_id]
+                served.pop(key, None)
+            elif served[key] >= self._weights.get(session_id, 1):
+                # Turn is over; move the session to the back of the round robin
+                sessions.move_to_end(session_id)
+                served[key] = 0
+            return ticket
+        return None
+
+    def _dispatch(self):
+        """Grant slots to waiting tickets while capacity remains (lock must be held)"""
+        granted = False
+        while self._active < self.max_concurrency:
+            ticket = self._next_ticket(self._queues, self._served_this_turn)
+            if ticket is None:
+                break
+            ticket.granted = True
+            self._active += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def queue_position(self, session_id):
+        """How many calls will be admitted before this session's next waiting call (0 if none waiting)"""
+        with self._cond:
+            queues = {
+                priority: OrderedDict((sid, deque(tickets)) for sid, tickets in sessions.items())
+                for priority, sessions in self._queues.items()
+            }
+            served = dict(self._served_this_turn)
+            position = 0
+            while True:
+                ticket = self._next_ticket(queues, served)
+                if ticket is None:
+                    return 0
+                if ticket.session_id == session_id:
+                    return position
+                position += 1
+
+    def stats(self):
+        """Snapshot of load and queueing delay"""
+        with self._cond:
+            waits = sorted(self._wait_times)
+            return {
+                "active": self._active,
+                "queued": sum(len(t) for sessions in self._queues.values() for t in sessions.values()),
+                "sessions_waiting": len({sid for sessions in self._queues.values() for sid in sessions}),
+                "completed": self._completed,
+                "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide scheduler shared by every Streamlit session"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler(
+                max_concurrency=int(os.getenv("MAX_CONCURRENT_API_CALLS", "8"))
+            )
+        return _scheduler
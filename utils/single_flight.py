@@ -0,0 +1,125 @@
+import copy
+import hashlib
+import json
+import threading
+from PIL import Image
+from utils.cancellation import CancelledError
+
+
+class _Flight:
+    def __init__(self):
+        """An in-flight call that duplicate callers can wait on"""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self._copy_lock = threading.Lock()
+
+    def shared_result(self):
+        """A private copy of the result, so no caller can change what another one received"""
+        with self._copy_lock:
+            if isinstance(self.result, Image.Image):
+                return self.result.copy()
+            return copy.deepcopy(self.result)
+
+
+class SingleFlight:
+    def __init__(self):
+        """Coalesce identical concurrent requests into one upstream call"""
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {}
+
+    def _count(self, endpoint, field):
+        """Bump a per-endpoint counter (lock must be held)"""
+        counters = self._stats.setdefault(endpoint, {"calls": 0, "executed": 0, "coalesced": 0, "errors": 0})
+        counters[field] += 1
+
+    def do(self, endpoint, key, func, cancel_token=None, poll_interval=0.1):
+        """Return func()'s result, sharing it with concurrent callers of the same endpoint and key
+
+        Callers that arrive while an identical call is in flight wait for it and
+        receive its result or error instead of issuing their own request. If the
+        leading caller is cancelled, a waiting caller that is still live retries.
+        Once a result is shared, every caller gets its own copy of it.
+        """
+        flight_key = (endpoint, key)
+        with self._lock:
+            self._count(endpoint, "calls")
+
+        while True:
+            with self._lock:
+                flight = self._flights.get(flight_key)
+                leader = flight is None
+                if leader:
+                    flight = _Flight()
+                    self._flights[flight_key] = flight
+                    self._count(endpoint, "executed")
+                else:
+                    flight.waiters += 1
+                    self._count(endpoint, "coalesced")
+
+            if leader:
+                try:
+                    flight.result = func()
+                except BaseException as e:
+                    flight.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        if flight.error is not None and not isinstance(flight.error, CancelledError):
+                            self._count(endpoint, "errors")
+                        del self._flights[flight_key]
+                    flight.done.set()
+                # The flight is unregistered now, so no more callers can join it
+                return flight.shared_result() if flight.waiters else flight.result
+
+            while not flight.done.wait(poll_interval):
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+
+            if isinstance(flight.error, CancelledError):
+                # The leader gave up, not the request; try again unless we were cancelled too
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.shared_result()
+
+    def stats(self):
+        """Per-endpoint counts of calls, upstream executions and coalesced duplicates"""
+        with self._lock:
+            stats = {}
+            for endpoint, counters in self._stats.items():
+                stats[endpoint] = dict(counters)
+                stats[endpoint]["coalesce_rate"] = (
+                    counters["coalesced"] / counters["calls"] if counters["calls"] else 0.0
+                )
+            return stats
+
+
+def request_key(*parts):
+    """Stable hash of the normalized parts of a request"""
+    normalized = [" ".join(part.split()) if isinstance(part, str) else part for part in parts]
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def image_key(image):
+    """Stable hash of an image's pixels"""
+    digest = hashlib.sha256(image.tobytes())
+    digest.update(f"{image.mode}:{image.size}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Process-wide single-flight group shared by every Streamlit session"""
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
@@ -1,17 +1,65 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
+from utils.cancellation import CancellationToken, CancelledError, request_timeout
+from utils.scheduled_api import ScheduledAPIMixin
+from utils.scheduler import INTERACTIVE
+from utils.single_flight import request_key
 
-class StoryGenerator:
-    def __init__(self):
+STORY_SYSTEM_PROMPT = ("You are an expert storyteller and creative writer. "
+                       "Create engaging, coherent stories that can be visualized effectively. "
+                       "Always respond with valid JSON format.")
+
+PROMPT_SYSTEM_PROMPT = ("You are an expert at creating prompts for AI image generation models. "
+                        "Focus on visual consistency and artistic quality.")
+
+# Stories longer than this many words are written outline-first with scenes in parallel
+OUTLINE_WORD_THRESHOLD = 600
+
+class StoryGenerator(ScheduledAPIMixin):
+    def __init__(self, scenes_per_chunk=2, max_workers=5, session_id=None, priority=INTERACTIVE, scheduler=None,
+                 single_flight=None):
         """Initialize the story generator with OpenAI client"""
         self.openai_client = OpenAI(
             api_key=os.getenv("OPENAI_API_KEY", "your-openai-api-key")
         )
+        self._init_scheduling(session_id, priority, scheduler, single_flight)
+        self.scenes_per_chunk = scenes_per_chunk
+        self.max_workers = max_workers
+    
+    def generate_story(self, image_analysis, num_scenes=5, genre="Adventure", story_idea="", words_per_page=50,
+                       cancel_token=None, use_outline=None):
+        """Generate a coherent story based on image analysis
+        
+        With use_outline=None the outline-then-scenes mode is chosen automatically
+        for long stories; pass True or False to force either mode.
+        """
+        if use_outline is None:
+            use_outline = num_scenes * words_per_page > OUTLINE_WORD_THRESHOLD
+        
+        key = request_key(image_analysis, num_scenes, genre, story_idea, words_per_page, use_outline)
+        return self.single_flight.do(
+            "generate_story",
+            key,
+            lambda: self._generate_story(
+                image_analysis, num_scenes, genre, story_idea, words_per_page, cancel_token, use_outline
+            ),
+            cancel_token
+        )
     
-    def generate_story(self, image_analysis, num_scenes=5, genre="Adventure", story_idea="", words_per_page=50):
-        """Generate a coherent story based on image analysis"""
+    def _generate_story(self, image_analysis, num_scenes, genre, story_idea, words_per_page, cancel_token,
+                        use_outline):
+        """Generate the story for generate_story, in one call or outline-first"""
         try:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            
+            if use_outline:
+                return self._generate_story_from_outline(
+                    image_analysis, num_scenes, genre, story_idea, words_per_page, cancel_token
+                )
+            
             # Build the story prompt with user's idea
             story_direction = f"Story direction: {story_idea}" if story_idea.strip() else ""
             
@@ -60,14 +108,12 @@ class StoryGenerator:
             
             # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
             # do not change this unless explicitly requested by the user
-            response = self.openai_client.chat.completions.create(
+            response = self._call_api(lambda: self.openai_client.chat.completions.create(
                 model="gpt-4o",
                 messages=[
                     {
                         "role": "system",
-                        "content": "You are an expert storyteller and creative writer. "
-                                 "Create engaging, coherent stories that can be visualized effectively. "
-                                 "Always respond with valid JSON format."
+                        "content": STORY_SYSTEM_PROMPT
                     },
                     {
                         "role": "user",
@@ -75,8 +121,9 @@ class StoryGenerator:
                     }
                 ],
                 response_format={"type": "json_object"},
-                max_tokens=2000
-            )
+                max_tokens=2000,
+                timeout=request_timeout(cancel_token)
+            ), cancel_token)
             
             content = response.choices[0].message.content
             if content:
@@ -89,11 +136,188 @@ class StoryGenerator:
             
             return story_data
             
+        except CancelledError:
+            raise
         except json.JSONDecodeError as e:
             raise Exception(f"Failed to parse story JSON: {str(e)}")
         except Exception as e:
             raise Exception(f"Failed to generate story: {str(e)}")
     
+    def _request_story_json(self, prompt, max_tokens, cancel_token=None, system_prompt=STORY_SYSTEM_PROMPT):
+        """Send a prompt and parse the JSON object it returns"""
+        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+        # do not change this unless explicitly requested by the user
+        response = self._call_api(lambda: self.openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            response_format={"type": "json_object"},
+            max_tokens=max_tokens,
+            timeout=request_timeout(cancel_token)
+        ), cancel_token)
+        
+        content = response.choices[0].message.content
+        if not content:
+            raise Exception("No content received from OpenAI")
+        return json.loads(content)
+    
+    def _generate_story_from_outline(self, image_analysis, num_scenes, genre, story_idea, words_per_page,
+                                     cancel_token=None):
+        """Write a short outline first, then the scene narratives in parallel chunks"""
+        outline = self._generate_outline(image_analysis, num_scenes, genre, story_idea, cancel_token)
+        
+        chunks = [list(range(start, min(start + self.scenes_per_chunk, num_scenes)))
+                  for start in range(0, num_scenes, self.scenes_per_chunk)]
+        
+        # If one chunk fails the story is discarded, so the other chunks are cancelled too
+        chunk_token = cancel_token.child() if cancel_token is not None else CancellationToken()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = [
+                executor.submit(self._retry_scene_narratives, outline, chunk, genre, words_per_page, chunk_token)
+                for chunk in chunks
+            ]
+            narratives = {}
+            # Collected as they finish so a failing chunk stops the others straight away
+            for future in as_completed(futures):
+                narratives.update(future.result())
+        finally:
+            chunk_token.cancel("story generation finished")
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        story_data = {
+            "title": outline["title"],
+            "introduction": outline["introduction"],
+            "scenes": [
+                {
+                    "description": beat["description"],
+                    "narrative": narratives[i]
+                }
+                for i, beat in enumerate(outline["scenes"])
+            ],
+            "conclusion": outline["conclusion"]
+        }
+        
+        self._validate_story_structure(story_data, num_scenes)
+        
+        return story_data
+    
+    def _generate_outline(self, image_analysis, num_scenes, genre, story_idea, cancel_token=None):
+        """Fix the title, main character and per-scene beats in one short call"""
+        story_direction = f"Story direction: {story_idea}" if story_idea.strip() else ""
+        
+        outline_prompt = f"""
+        Based on the following image analysis, outline a compelling {genre.lower()} story with exactly {num_scenes} scenes.
+        
+        Image Analysis:
+        {image_analysis}
+        
+        {story_direction}
+        
+        Requirements:
+        1. IDENTIFY the main character/subject from the image analysis (animal, person, object)
+        2. This SAME character must be the protagonist in EVERY scene without exception
+        3. Every scene description must begin with "The [character type/name] from the reference image"
+        4. Each beat is one or two sentences saying what happens in that scene
+        5. Keep the introduction and conclusion to a short paragraph each
+        
+        Genre: {genre}
+        
+        Respond with a JSON object in this exact format:
+        {{
+            "title": "Story Title",
+            "character": "Who the main character is and how they look",
+            "introduction": "Introduction paragraph",
+            "scenes": [
+                {{
+                    "description": "Brief visual description for image generation that includes the main character",
+                    "beat": "What happens in this scene"
+                }}
+            ],
+            "conclusion": "Conclusion paragraph"
+        }}
+        """
+        
+        outline = self._request_story_json(outline_prompt, min(2000, 400 + 120 * num_scenes), cancel_token)
+        
+        for field in ['title', 'character', 'introduction', 'scenes', 'conclusion']:
+            if field not in outline:
+                raise Exception(f"Missing required field in story outline: {field}")
+        if not isinstance(outline['scenes'], list) or len(outline['scenes']) != num_scenes:
+            raise Exception(f"Expected {num_scenes} scenes in story outline")
+        for i, beat in enumerate(outline['scenes']):
+            if 'description' not in beat or 'beat' not in beat:
+                raise Exception(f"Outline scene {i+1} missing required fields (description, beat)")
+        
+        return outline
+    
+    def _retry_scene_narratives(self, outline, scene_indexes, genre, words_per_page, cancel_token=None):
+        """Write a chunk's narratives, retrying once so one bad response does not discard the outline"""
+        try:
+            return self._generate_scene_narratives(outline, scene_indexes, genre, words_per_page, cancel_token)
+        except CancelledError:
+            raise
+        except Exception:
+            return self._generate_scene_narratives(outline, scene_indexes, genre, words_per_page, cancel_token)
+    
+    def _generate_scene_narratives(self, outline, scene_indexes, genre, words_per_page, cancel_token=None):
+        """Write the narratives for a chunk of scenes, constrained by the outline"""
+        beats = "\n".join(
+            f"Scene {i+1}: {beat['beat']}" for i, beat in enumerate(outline['scenes'])
+        )
+        scene_numbers = ", ".join(str(i + 1) for i in scene_indexes)
+        
+        chunk_prompt = f"""
+        You are writing part of the {genre.lower()} story "{outline['title']}".
+        
+        Main character: {outline['character']}
+        
+        Introduction:
+        {outline['introduction']}
+        
+        Outline of every scene:
+        {beats}
+        
+        Write the narrative for scenes {scene_numbers} only. Follow the outline exactly, keep the
+        same main character throughout, and make each narrative approximately {words_per_page} words.
+        
+        Respond with a JSON object in this exact format:
+        {{
+            "narratives": [
+                {{
+                    "scene": 1,
+                    "narrative": "Story narrative for this scene"
+                }}
+            ]
+        }}
+        """
+        
+        max_tokens = min(4000, 200 + 2 * words_per_page * len(scene_indexes))
+        result = self._request_story_json(chunk_prompt, max_tokens, cancel_token)
+        
+        narratives = {}
+        for entry in result.get('narratives', []):
+            try:
+                index = int(entry['scene']) - 1
+            except (KeyError, TypeError, ValueError):
+                continue
+            if index in scene_indexes and entry.get('narrative'):
+                narratives[index] = entry['narrative']
+        
+        missing = [i + 1 for i in scene_indexes if i not in narratives]
+        if missing:
+            raise Exception(f"Missing narrative for scene(s) {', '.join(map(str, missing))}")
+        
+        return narratives
+    
     def _validate_story_structure(self, story_data, expected_scenes):
         """Validate the generated story structure"""
         required_fields = ['title', 'introduction', 'scenes', 'conclusion']
@@ -112,9 +336,12 @@ class StoryGenerator:
             if 'description' not in scene or 'narrative' not in scene:
                 raise Exception(f"Scene {i+1} missing required fields (description, narrative)")
     
-    def enhance_scene_description(self, scene_description, visual_features, style):
+    def enhance_scene_description(self, scene_description, visual_features, style, cancel_token=None):
         """Enhance scene description with visual consistency prompts"""
         try:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            
             enhancement_prompt = f"""
             Enhance this scene description for image generation while maintaining visual consistency:
             
@@ -137,25 +364,107 @@ class StoryGenerator:
             
             # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
             # do not change this unless explicitly requested by the user
-            response = self.openai_client.chat.completions.create(
+            response = self._call_api(lambda: self.openai_client.chat.completions.create(
                 model="gpt-4o",
                 messages=[
                     {
                         "role": "system",
-                        "content": "You are an expert at creating prompts for AI image generation models. "
-                                 "Focus on visual consistency and artistic quality."
+                        "content": PROMPT_SYSTEM_PROMPT
                     },
                     {
                         "role": "user",
                         "content": enhancement_prompt
                     }
                 ],
-                max_tokens=300
-            )
+                max_tokens=300,
+                timeout=request_timeout(cancel_token)
+            ), cancel_token)
             
             content = response.choices[0].message.content
             return content.strip() if content else scene_description
             
+        except CancelledError:
+            raise
         except Exception as e:
             # Return original description if enhancement fails
             return scene_description
+    
+    def enhance_scene_descriptions(self, scene_descriptions, visual_features, style, cancel_token=None):
+        """Enhance all scene descriptions in one request sharing the visual features and style
+        
+        Entries missing or malformed in the batch response are enhanced one by one
+        with enhance_scene_description, which falls back to the original description.
+        """
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        if not scene_descriptions:
+            return []
+        
+        scenes = "\n".join(
+            f"{i+1}. {description}" for i, description in enumerate(scene_descriptions)
+        )
+        
+        enhancement_prompt = f"""
+        Enhance each of these {len(scene_descriptions)} scene descriptions for image generation while maintaining visual consistency:
+        
+        {scenes}
+        
+        Visual consistency requirements (shared by every scene):
+        {visual_features}
+        
+        Desired style: {style}
+        
+        Create one enhanced prompt per scene that:
+        1. Maintains the original scene's essence
+        2. Incorporates visual consistency elements
+        3. Specifies the desired artistic style
+        4. Is optimized for diffusion model generation
+        5. Is concise but descriptive (under 200 words)
+        
+        Respond with a JSON object in this exact format, with one entry per scene numbered as above:
+        {{
+            "prompts": [
+                {{
+                    "scene": 1,
+                    "prompt": "Enhanced prompt for this scene"
+                }}
+            ]
+        }}
+        """
+        
+        enhanced = [None] * len(scene_descriptions)
+        try:
+            max_tokens = min(4000, 300 * len(scene_descriptions))
+            result = self._request_story_json(enhancement_prompt, max_tokens, cancel_token, PROMPT_SYSTEM_PROMPT)
+            prompts = result.get("prompts") if isinstance(result, dict) else None
+            # Entries are matched by scene number, so a skipped or reordered scene cannot shift the rest
+            for entry in prompts if isinstance(prompts, list) else []:
+                try:
+                    index = int(entry["scene"]) - 1
+                    prompt = entry["prompt"]
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if 0 <= index < len(scene_descriptions) and isinstance(prompt, str) and prompt.strip():
+                    enhanced[index] = prompt.strip()
+        except CancelledError:
+            raise
+        except Exception:
+            # A malformed batch response falls back to per-scene enhancement below
+            pass
+        
+        missing = [i for i, prompt in enumerate(enhanced) if prompt is None]
+        if missing:
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            try:
+                futures = {
+                    i: executor.submit(
+                        self.enhance_scene_description, scene_descriptions[i], visual_features, style, cancel_token
+                    )
+                    for i in missing
+                }
+                for i, future in futures.items():
+                    enhanced[i] = future.result()
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+        
+        return enhanced